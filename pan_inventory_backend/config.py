@@ -24,7 +24,9 @@ paloalto = {
     'username': '<USERNAME>',
     'password': '<PASSWORD>',
     'key': '<API_KEY>',
-    'panorama_ips': ['<PANO_MGMT_IP1>', '<PANO_MGMT_IP2>']
+    'panorama_ips': ['<PANO_MGMT_IP1>', '<PANO_MGMT_IP2>'],
+    'stream_connected_devices': False,
+    'proxy_through_panorama': False
     }
 
 mongo = {
@@ -39,5 +41,17 @@ mongo = {
     }
 
 directories = {
-    'log': '/usr/local/bin/log'
+    'log': '/usr/local/bin/log',
+    'cache': '/usr/local/bin/cache',
+    'snapshot': '/usr/local/bin/snapshot'
+}
+
+occupancy = {
+    'recheck_hours': 168,
+    'reboot_tolerance_seconds': 300
+}
+
+logs = {
+    'level': 'DEBUG',
+    'structured': False
 }
\ No newline at end of file
@@ -22,6 +22,11 @@
 
 import re
 import os
+import gzip
+import json
+import time
+import datetime
+import queue
 import logging
 import logging.handlers as handlers
 from pandevice import panorama
@@ -30,11 +35,34 @@ from pymongo import MongoClient
 import pan_module as pa
 import config
 
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as JSON lines for structured log ingestion
+    """
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'line': record.lineno,
+            'function': record.funcName,
+            'msg': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
 # Logging
+log_level = getattr(logging, config.logs['level'].upper(), logging.DEBUG)
+
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+logger.setLevel(log_level)
 
-formatter = logging.Formatter('%(asctime)s   Log Level: %(levelname)-8s   Line: %(lineno)-3d   Function: %(funcName)-21s   Msg: %(message)s', datefmt='%m/%d %I:%M:%S %p')
+if config.logs['structured']:
+    formatter = JsonFormatter(datefmt='%Y-%m-%dT%H:%M:%S')
+else:
+    formatter = logging.Formatter('%(asctime)s   Log Level: %(levelname)-8s   Line: %(lineno)-3d   Function: %(funcName)-21s   Msg: %(message)s', datefmt='%m/%d %I:%M:%S %p')
 
 log_dir = config.directories['log']
 log_file = (os.path.join(log_dir, 'pa_inventory.log'))
@@ -43,9 +71,8 @@ log_handler = handlers.TimedRotatingFileHandler(
     when='midnight',
     backupCount=2
 )
-log_handler.setLevel(logging.DEBUG)
+log_handler.setLevel(log_level)
 log_handler.setFormatter(formatter)
-logger.addHandler(log_handler)
 
 error_log_file = (os.path.join(log_dir, 'pa_inventory_errors.log'))
 error_log_handler = handlers.TimedRotatingFileHandler(
@@ -55,10 +82,189 @@ error_log_handler = handlers.TimedRotatingFileHandler(
 )
 error_log_handler.setLevel(logging.ERROR)
 error_log_handler.setFormatter(formatter)
-logger.addHandler(error_log_handler)
+
+# Records are handed off to a queue and written to disk by a listener thread
+# so file I/O stays off the polling path
+log_queue = queue.Queue(-1)
+logger.addHandler(handlers.QueueHandler(log_queue))
+log_listener = handlers.QueueListener(
+    log_queue,
+    log_handler,
+    error_log_handler,
+    respect_handler_level=True
+)
+
+occupancy_file = os.path.join(config.directories['cache'], 'pa_occupancy.json')
+
+SNAPSHOT_VERSION = 1
+snapshot_file = os.path.join(config.directories['snapshot'],
+                             'pa_inventory.jsonl.gz')
+
+
+def load_occupancy():
+    """
+    Loads the per-chassis occupancy map saved by the previous run
+
+    Returns
+    -------
+    occupancy : dict
+        A dictionary of chassis occupancy keyed by serial number, in format of
+            dict: {
+                'serial_number': {
+                    'probed': float,
+                    'boot': float,
+                    'empty': {
+                        'chassis': [int],
+                        'power-supply': [int],
+                        'fantray': [int]
+                        },
+                    'present': {
+                        'fantray': [int]
+                        }
+                    }
+            }
+    """
+    try:
+        with open(occupancy_file) as occupancy_json:
+            return json.load(occupancy_json)
+    except (IOError, ValueError) as error:
+        logger.info('No usable occupancy map, probing all positions: %s', error)
+        return {}
+
+
+def save_occupancy(occupancy):
+    """
+    Writes the occupancy map to disk for the next run
+
+    Parameters
+    ----------
+    occupancy : dict
+        A dictionary of chassis occupancy keyed by serial number
+    """
+    temp_file = occupancy_file + '.tmp'
+    try:
+        with open(temp_file, 'w') as occupancy_json:
+            json.dump(occupancy, occupancy_json)
+        os.replace(temp_file, occupancy_file)
+    except (IOError, OSError) as error:
+        logger.error('Could not save occupancy map: %s', error)
+
+
+def get_chassis_occupancy(occupancy, serial, uptime):
+    """
+    Gets the occupancy entry for a chassis, starting a fresh one when the
+    chassis is new, has rebooted, or is due for a full re-probe
+
+    Parameters
+    ----------
+    occupancy : dict
+        A dictionary of chassis occupancy keyed by serial number
+    serial : str
+        The serial number of the firewall
+    uptime : str
+        The uptime of the firewall as reported by Panorama
+
+    Returns
+    -------
+    chassis_occupancy : dict
+        The occupancy entry for the chassis
+    """
+    now = time.time()
+    uptime_seconds = pa.parse_uptime(uptime)
+    boot = now - uptime_seconds if uptime_seconds is not None else None
+
+    recheck_seconds = config.occupancy['recheck_hours'] * 3600
+    tolerance = config.occupancy['reboot_tolerance_seconds']
+
+    chassis_occupancy = occupancy.get(serial)
+
+    if chassis_occupancy is not None:
+        stored_boot = chassis_occupancy.get('boot')
+        if now - chassis_occupancy.get('probed', 0) > recheck_seconds:
+            logger.debug('%s due for full re-probe', serial)
+            chassis_occupancy = None
+        elif (boot is not None and stored_boot is not None
+              and abs(boot - stored_boot) > tolerance):
+            logger.debug('%s rebooted since last probe', serial)
+            chassis_occupancy = None
+
+    if chassis_occupancy is None:
+        chassis_occupancy = {
+            'probed': now,
+            'boot': boot,
+            'empty': {'chassis': [], 'power-supply': [], 'fantray': []},
+            'present': {'fantray': []}
+        }
+        occupancy[serial] = chassis_occupancy
+
+    return chassis_occupancy
+
+
+def record_change(history, ip_addr, path, old, new):
+    """
+    Appends a change event to the history collection
+
+    Parameters
+    ----------
+    history : Collection
+        The MongoDB change history collection
+    ip_addr : str
+        The IP address of the device
+    path : str
+        The changed component, e.g. 'sw-version' or 'chassis/3/serial'
+    old : str
+        The previously stored value, None for a new device or component
+    new : str
+        The newly collected value
+    """
+    history.insert_one({
+        'ip-address': ip_addr,
+        'path': path,
+        'old': old,
+        'new': new,
+        'timestamp': datetime.datetime.utcnow()
+    })
+    logger.info('%s %s changed from %s to %s', ip_addr, path, old, new)
 
 
-def get_connected_devices(pano, collection):
+def create_history_indexes(history):
+    """
+    Creates the indexes used to query a device's or a serial's timeline
+
+    Parameters
+    ----------
+    history : Collection
+        The MongoDB change history collection
+    """
+    history.create_index([('ip-address', 1), ('timestamp', -1)])
+    history.create_index([('old', 1), ('timestamp', -1)])
+    history.create_index([('new', 1), ('timestamp', -1)])
+
+
+COLLECTORS = {}
+
+
+def collector(name):
+    """
+    Registers a hardware collector under the name used in the 'collectors'
+    command plan of pan_module.MODEL_PROFILES
+
+    Collectors are called with the firewall, inventory and history
+    collections, IP address, model profile, and chassis occupancy entry, which
+    is None unless the profile sets 'occupancy'
+
+    Parameters
+    ----------
+    name : str
+        The collector name
+    """
+    def register(func):
+        COLLECTORS[name] = func
+        return func
+    return register
+
+
+def get_connected_devices(pano, collection, history):
     """
     Get the connected devices info from Panorama and adds/updates database
     with serial number, hostname, family, model, and ip of firewall
@@ -69,6 +275,8 @@ def get_connected_devices(pano, collection):
         A PanDevice for Panorama
     collection : Collection
         A MongoDB database collection
+    history : Collection
+        The MongoDB change history collection
 
     Returns
     -------
@@ -77,28 +285,27 @@ def get_connected_devices(pano, collection):
             dict: {
                 'serial_number': {
                     'ip_address': str,
-                    'model': str
+                    'model': str,
+                    'uptime': str
                     }
             }
     """
     logger.info('Getting connected devices')
-    results = pano.op('show devices connected')
 
     device_dict = {}
 
-    devices_xml_list = results.findall('./result/devices/entry')
-
-    for device in devices_xml_list:
-        serial = device.find('./serial').text
-        hostname = device.find('./hostname').text
-        ip_addr = device.find('./ip-address').text
-        family = device.find('./family').text
-        model = device.find('./model').text
-        sw_version = device.find('./sw-version').text
+    for device in pa.iter_connected_devices(pano):
+        serial = device.get('serial')
+        hostname = device.get('hostname')
+        ip_addr = device.get('ip-address')
+        family = device.get('family')
+        model = device.get('model')
+        sw_version = device.get('sw-version')
 
-        if family == '7000':
+        if model in pa.MODEL_PROFILES:
             device_dict[serial] = {'ip-address': ip_addr,
-                                   'model': model}
+                                   'model': model,
+                                   'uptime': device.get('uptime')}
 
         find_results = collection.find_one(
             {'ip-address': ip_addr},
@@ -118,6 +325,8 @@ def get_connected_devices(pano, collection):
                 }
             )
             logger.debug(insert_results)
+            record_change(history, ip_addr, 'serial', None, serial)
+            record_change(history, ip_addr, 'sw-version', None, sw_version)
         else:
             stored_serial = find_results.get('serial')
             if stored_serial != serial:
@@ -125,24 +334,32 @@ def get_connected_devices(pano, collection):
                     {"ip-address": ip_addr},
                     {'$set': {'serial': serial}}
                 )
-                logger.debug('Update Serial Number -- Matched: {} -- Modified: {}'.format(update_serial.matched_count, update_serial.modified_count))
+                logger.debug('Update Serial Number -- Matched: %s -- Modified: %s', update_serial.matched_count, update_serial.modified_count)
+                record_change(history, ip_addr, 'serial', stored_serial,
+                              serial)
 
-        stored_sw_version = find_results.get('sw-version')
-        if stored_sw_version != sw_version:
-            update_sw_version = collection.update_one(
-                {"ip-address": ip_addr},
-                {'$set': {'sw-version': sw_version}}
-            )
-            logger.debug('Update Software Version -- Matched: {} -- Modified: {}'.format(update_sw_version.matched_count, update_sw_version.modified_count))
+            stored_sw_version = find_results.get('sw-version')
+            if stored_sw_version != sw_version:
+                update_sw_version = collection.update_one(
+                    {"ip-address": ip_addr},
+                    {'$set': {'sw-version': sw_version}}
+                )
+                logger.debug('Update Software Version -- Matched: %s -- Modified: %s', update_sw_version.matched_count, update_sw_version.modified_count)
+                record_change(history, ip_addr, 'sw-version',
+                              stored_sw_version, sw_version)
 
     logger.debug(device_dict)
     return device_dict
 
 
-def get_7K_info(device_dict, collection):
+def get_hardware_info(device_dict, collection, history, pano):
     """
-    Checks Palo firewall to see if model and family are in the 7K family,
-    sets variables, and then gets 7K info
+    Looks up the hardware profile of each firewall model and runs the
+    collectors in its command plan
+
+    With 'proxy_through_panorama' enabled the firewalls are queried through
+    Panorama by serial number over one persistent connection, instead of
+    connecting to each firewall's management IP
 
     Parameters
     ----------
@@ -150,35 +367,85 @@ def get_7K_info(device_dict, collection):
         A dictionary of Panorama connected devices
     collection : Collection
         A MongoDB database collection
+    history : Collection
+        The MongoDB change history collection
+    pano : Panorama
+        A PanDevice for the active Panorama
     """
     logger.info('Starting')
 
     key = config.paloalto['key']
+    proxy = config.paloalto.get('proxy_through_panorama', False)
+    occupancy = load_occupancy()
+    start = time.time()
+
+    connection = pa.PanoramaConnection(pano) if proxy else None
 
+    try:
+        collect_hardware_info(device_dict, collection, history, occupancy,
+                              key, connection)
+    finally:
+        if connection is not None:
+            connection.close()
+
+    logger.info('Collected hardware info for %s devices in %.2f seconds (%s)',
+                len(device_dict), time.time() - start,
+                'proxied' if proxy else 'direct')
+    save_occupancy(occupancy)
+
+
+def collect_hardware_info(device_dict, collection, history, occupancy, key,
+                          connection):
+    """
+    Runs the collectors in each profiled firewall's command plan
+
+    Parameters
+    ----------
+    device_dict : dict
+        A dictionary of Panorama connected devices
+    collection : Collection
+        A MongoDB database collection
+    history : Collection
+        The MongoDB change history collection
+    occupancy : dict
+        A dictionary of chassis occupancy keyed by serial number
+    key : str
+        The API key for direct firewall connections
+    connection : PanoramaConnection
+        The persistent Panorama connection to proxy through, or None to
+        connect to each firewall directly
+    """
     for device in device_dict:
         fw_dict = device_dict.get(device)
         model = fw_dict.get('model')
         ip_addr = fw_dict.get('ip-address')
+        uptime = fw_dict.get('uptime')
+
+        profile = pa.MODEL_PROFILES.get(model)
+        if profile is None:
+            logger.debug('No hardware profile for %s, skipping %s', model, ip_addr)
+            continue
+
+        if profile.get('occupancy'):
+            chassis_occupancy = get_chassis_occupancy(occupancy, device,
+                                                      uptime)
+        else:
+            chassis_occupancy = None
+            occupancy.pop(device, None)
 
-        if model == 'PA-7080':
-            smc_slot = '6'
-            lpc_slot = '7'
-            ps_total = 8
-            slot_total = 12
-        elif model == 'PA-7050':
-            smc_slot = '4'
-            lpc_slot = '8'
-            ps_total = 4
-            slot_total = 8
+        if connection is not None:
+            fw = pa.ProxiedFirewall(connection, device)
+        else:
+            fw = firewall.Firewall(hostname=ip_addr, api_key=key)
 
-        fw = firewall.Firewall(hostname=ip_addr, api_key=key)
-        get_7K_chassis_info(fw, collection, ip_addr, slot_total)
-        get_7K_power_info(fw, collection, ip_addr, smc_slot, ps_total)
-        get_7K_fan_info(fw, collection, ip_addr, smc_slot)
-        get_7K_amc_info(fw, collection, ip_addr, lpc_slot)
+        for name in profile['collectors']:
+            COLLECTORS[name](fw, collection, history, ip_addr, profile,
+                             chassis_occupancy)
 
 
-def get_7K_chassis_info(fw, collection, ip_addr, slot_total):
+@collector('chassis')
+def get_7K_chassis_info(fw, collection, history, ip_addr, profile,
+                        chassis_occupancy):
     """
     Gets Palo 7K chassis info if chassis slot is occupied and adds/updates
     database
@@ -189,13 +456,23 @@ def get_7K_chassis_info(fw, collection, ip_addr, slot_total):
         A PanDevice for the firewall
     collection : Collection
         A MongoDB database collection
+    history : Collection
+        The MongoDB change history collection
     ip_addr : str
         The IP address of the firewall
-    slot_total : int
-        The total number of slots in the chassis
+    profile : dict
+        The hardware profile of the firewall model
+    chassis_occupancy : dict
+        The occupancy entry for the chassis, known-empty slots are skipped
     """
     logger.info('Starting')
+    slot_total = profile['slot_total']
+    empty_slots = chassis_occupancy['empty']['chassis']
+
     for num in range(1, (slot_total + 1)):
+        if num in empty_slots:
+            continue
+
         chassis_cmd = ('<show><system><state><filter>chassis.s{}.info'
                        '</filter></state></system></show>'.format(str(num)))
         results = fw.op(cmd=chassis_cmd, cmd_xml=False, xml=True)
@@ -203,7 +480,9 @@ def get_7K_chassis_info(fw, collection, ip_addr, slot_total):
 
         if chassis_info is not None:
             chassis_type = chassis_info.group(4)
-            if chassis_type != 'Empty':
+            if chassis_type == 'Empty':
+                empty_slots.append(num)
+            else:
                 model = chassis_info.group(1)
                 serial = chassis_info.group(2)
                 slot = chassis_info.group(3)
@@ -222,7 +501,7 @@ def get_7K_chassis_info(fw, collection, ip_addr, slot_total):
                 )
                 logger.debug(find_results)
 
-                if find_results is None:
+                if not find_results:
                     update_results = collection.update_one(
                         {'ip-address': ip_addr},
                         {'$addToSet': {'chassis': {
@@ -232,7 +511,10 @@ def get_7K_chassis_info(fw, collection, ip_addr, slot_total):
                             'type': chassis_type
                         }}}
                     )
-                    logger.debug('Matched: {} -- Modified: {}'.format(update_results.matched_count, update_results.modified_count))
+                    logger.debug('Matched: %s -- Modified: %s', update_results.matched_count, update_results.modified_count)
+                    record_change(history, ip_addr,
+                                  'chassis/{}/serial'.format(slot), None,
+                                  serial)
                 else:
                     chassis_dict = find_results.get('chassis')[0]
                     stored_serial = chassis_dict.get('serial')
@@ -243,10 +525,15 @@ def get_7K_chassis_info(fw, collection, ip_addr, slot_total):
                             {'ip-address': ip_addr, 'chassis.slot': slot},
                             {'$set': {'chassis.$.serial': serial}}
                         )
-                        logger.debug('Update Chassis Card Serial Number -- Matched: {} -- Modified: {}'.format(update_results.matched_count, update_results.modified_count))
+                        logger.debug('Update Chassis Card Serial Number -- Matched: %s -- Modified: %s', update_results.matched_count, update_results.modified_count)
+                        record_change(history, ip_addr,
+                                      'chassis/{}/serial'.format(slot),
+                                      stored_serial, serial)
 
 
-def get_7K_power_info(fw, collection, ip_addr, smc_slot, ps_total):
+@collector('power')
+def get_7K_power_info(fw, collection, history, ip_addr, profile,
+                      chassis_occupancy):
     """
     Gets Palo 7K power supply info if present and adds/updates database
 
@@ -256,15 +543,25 @@ def get_7K_power_info(fw, collection, ip_addr, smc_slot, ps_total):
         A PanDevice for the firewall
     collection : Collection
         A MongoDB database collection
+    history : Collection
+        The MongoDB change history collection
     ip_addr : str
         The IP address of the firewall
-    smc_slot : str
-        The SMC (Switch Management Card) slot location in the chassis
-    ps_total : int
-        The total number of power supplies in the chassis
+    profile : dict
+        The hardware profile of the firewall model
+    chassis_occupancy : dict
+        The occupancy entry for the chassis, known-absent power supplies are
+        skipped
     """
     logger.info('Starting')
+    smc_slot = profile['smc_slot']
+    ps_total = profile['ps_total']
+    empty_supplies = chassis_occupancy['empty']['power-supply']
+
     for num in range(0, ps_total):
+        if num in empty_supplies:
+            continue
+
         power_cmd = ('<show><system><state><filter>env.s{}.power-supply.{}'
                      '</filter></state></system></show>'
                      .format(smc_slot, str(num)))
@@ -273,7 +570,25 @@ def get_7K_power_info(fw, collection, ip_addr, smc_slot, ps_total):
 
         if ps_info is not None:
             ps_present = ps_info.group(3)
-            if ps_present == 'True':
+            if ps_present != 'True':
+                empty_supplies.append(num)
+
+                # Keep the stored supply but mark it removed so it is not
+                # counted as installed
+                desc = ps_info.group(1)
+                update_results = collection.update_one(
+                    {'ip-address': ip_addr, 'power-supply': {'$elemMatch': {
+                        'desc': desc,
+                        'present': {'$ne': False}
+                    }}},
+                    {'$set': {'power-supply.$.present': False}}
+                )
+                logger.debug('Update Power Supply Present -- Matched: %s -- Modified: %s', update_results.matched_count, update_results.modified_count)
+                if update_results.modified_count:
+                    record_change(history, ip_addr,
+                                  'power-supply/{}/present'.format(desc),
+                                  True, False)
+            else:
                 desc = ps_info.group(1)
                 model = ps_info.group(2)
                 serial = ps_info.group(4)
@@ -284,30 +599,49 @@ def get_7K_power_info(fw, collection, ip_addr, smc_slot, ps_total):
                 )
                 logger.debug(find_results)
 
-                if find_results is None:
+                if not find_results:
                     update_results = collection.update_one(
                         {"ip-address": ip_addr},
                         {'$addToSet': {'power-supply': {
                             'model': model,
                             'serial': serial,
-                            'desc': desc
+                            'desc': desc,
+                            'present': True
                         }}}
                     )
-                    logger.debug('Matched: {} -- Modified: {}'.format(update_results.matched_count, update_results.modified_count))
+                    logger.debug('Matched: %s -- Modified: %s', update_results.matched_count, update_results.modified_count)
+                    record_change(history, ip_addr,
+                                  'power-supply/{}/serial'.format(desc), None, serial)
                 else:
                     powersupply_dict = find_results.get('power-supply')[0]
                     stored_serial = powersupply_dict.get('serial')
                     stored_desc = powersupply_dict.get('desc')
+                    stored_present = powersupply_dict.get('present')
+
+                    if stored_desc == desc and stored_present is False:
+                        update_results = collection.update_one(
+                            {'ip-address': ip_addr, 'power-supply.desc': desc},
+                            {'$set': {'power-supply.$.present': True}}
+                        )
+                        logger.debug('Update Power Supply Present -- Matched: %s -- Modified: %s', update_results.matched_count, update_results.modified_count)
+                        record_change(history, ip_addr,
+                                      'power-supply/{}/present'.format(desc),
+                                      False, True)
 
                     if stored_desc == desc and stored_serial != serial:
                         update_results = collection.update_one(
                             {'ip-address': ip_addr, 'power-supply.desc': desc},
                             {'$set': {'power-supply.$.serial': serial}}
                         )
-                        logger.debug('Update Power Supply Serial Number -- Matched: {} -- Modified: {}'.format(update_results.matched_count, update_results.modified_count))
+                        logger.debug('Update Power Supply Serial Number -- Matched: %s -- Modified: %s', update_results.matched_count, update_results.modified_count)
+                        record_change(history, ip_addr,
+                                      'power-supply/{}/serial'.format(desc),
+                                      stored_serial, serial)
 
 
-def get_7K_fan_info(fw, collection, ip_addr, smc_slot):
+@collector('fan')
+def get_7K_fan_info(fw, collection, history, ip_addr, profile,
+                    chassis_occupancy):
     """
     Gets Palo 7K fantray info if present and adds/updates database
 
@@ -317,19 +651,39 @@ def get_7K_fan_info(fw, collection, ip_addr, smc_slot):
         A PanDevice for the firewall
     collection : Collection
         A MongoDB database collection
+    history : Collection
+        The MongoDB change history collection
     ip_addr : str
         The IP address of the firewall
-    smc_slot : str
-        The SMC (Switch Management Card) slot location in the chassis
+    profile : dict
+        The hardware profile of the firewall model
+    chassis_occupancy : dict
+        The occupancy entry for the chassis, known-absent fantrays are skipped
+        and known-present fantrays skip the presence check
     """
     logger.info('Starting')
+    smc_slot = profile['smc_slot']
+    empty_trays = chassis_occupancy['empty']['fantray']
+    present_trays = chassis_occupancy['present']['fantray']
+
     for num in range(0, 2):
-        fantray_present_cmd = ('<show><system><state><filter>env.s{}.'
-                               'fantray-present.{}</filter></state></system>'
-                               '</show>'.format(smc_slot, str(num)))
-        results = fw.op(cmd=fantray_present_cmd, cmd_xml=False, xml=True)
-        fantray_present = re.sub(r'<response status="success"><result>env.s[4,6].fantray-present.[0-1]: ', '', results)
-        fantray_present = re.sub(r'\n</result></response>', '', fantray_present)
+        if num in empty_trays:
+            continue
+
+        if num in present_trays:
+            fantray_present = 'True'
+        else:
+            fantray_present_cmd = ('<show><system><state><filter>env.s{}.'
+                                   'fantray-present.{}</filter></state>'
+                                   '</system></show>'.format(smc_slot, str(num)))
+            results = fw.op(cmd=fantray_present_cmd, cmd_xml=False, xml=True)
+            fantray_present = re.sub(r'<response status="success"><result>env.s[4,6].fantray-present.[0-1]: ', '', results)
+            fantray_present = re.sub(r'\n</result></response>', '', fantray_present)
+
+            if fantray_present == 'True':
+                present_trays.append(num)
+            else:
+                empty_trays.append(num)
 
         if fantray_present == 'True':
             fantray_cmd = ('<show><system><state><filter>env.s{}.fantray.{}'
@@ -338,6 +692,10 @@ def get_7K_fan_info(fw, collection, ip_addr, smc_slot):
             fantray = fw.op(cmd=fantray_cmd, cmd_xml=False, xml=True)
             fantray_info = re.search(r"'desc':\s(.*),\s'min':.*'pan-model-no':\s(.*),\s'pan-serial-no':\s(.*),\s'power'", fantray)
 
+            # Re-check presence next run if a cached tray stops reporting
+            if fantray_info is None:
+                present_trays.remove(num)
+
             if fantray_info is not None:
                 desc = fantray_info.group(1)
                 model = fantray_info.group(2)
@@ -349,7 +707,7 @@ def get_7K_fan_info(fw, collection, ip_addr, smc_slot):
                 )
                 logger.debug(find_results)
 
-                if find_results is None:
+                if not find_results:
                     update_results = collection.update_one(
                         {"ip-address": ip_addr},
                         {'$addToSet': {'fantray': {
@@ -358,7 +716,9 @@ def get_7K_fan_info(fw, collection, ip_addr, smc_slot):
                             'desc': desc
                         }}}
                     )
-                    logger.debug('Matched: {} -- Modified: {}'.format(update_results.matched_count, update_results.modified_count))
+                    logger.debug('Matched: %s -- Modified: %s', update_results.matched_count, update_results.modified_count)
+                    record_change(history, ip_addr,
+                                  'fantray/{}/serial'.format(desc), None, serial)
                 else:
                     fantray_dict = find_results.get('fantray')[0]
                     stored_serial = fantray_dict.get('serial')
@@ -369,10 +729,15 @@ def get_7K_fan_info(fw, collection, ip_addr, smc_slot):
                             {'ip-address': ip_addr, 'fantray.desc': desc},
                             {'$set': {'fantray.$.serial': serial}}
                         )
-                        logger.debug('Update Fantray Serial Number -- Matched: {} -- Modified: {}'.format(update_results.matched_count, update_results.modified_count))
+                        logger.debug('Update Fantray Serial Number -- Matched: %s -- Modified: %s', update_results.matched_count, update_results.modified_count)
+                        record_change(history, ip_addr,
+                                      'fantray/{}/serial'.format(desc),
+                                      stored_serial, serial)
 
 
-def get_7K_amc_info(fw, collection, ip_addr, lpc_slot):
+@collector('amc')
+def get_7K_amc_info(fw, collection, history, ip_addr, profile,
+                    chassis_occupancy):
     """
     Gets Palo 7K AMC (Advanced Mezzanine Card) disk drive info and
     adds/updates database
@@ -383,12 +748,18 @@ def get_7K_amc_info(fw, collection, ip_addr, lpc_slot):
         A PanDevice for the firewall
     collection : Collection
         A MongoDB database collection
+    history : Collection
+        The MongoDB change history collection
     ip_addr : str
         The IP address of the firewall
-    lpc_slot : str
-        The LPC (Log Processing Card) slot location in the chassis
+    profile : dict
+        The hardware profile of the firewall model
+    chassis_occupancy : dict
+        The occupancy entry for the chassis
     """
     logger.info('Starting')
+    lpc_slot = profile['lpc_slot']
+
     for num in range(0, 4):
         amc_cmd = ('<show><system><state><filter>env.s{}.raid.{}</filter>'
                    '</state></system></show>'.format(lpc_slot, str(num)))
@@ -405,12 +776,14 @@ def get_7K_amc_info(fw, collection, ip_addr, lpc_slot):
             )
             logger.debug(find_results)
 
-            if find_results is None:
+            if not find_results:
                 update_results = collection.update_one(
                     {"ip-address": ip_addr},
                     {'$addToSet': {'amc': {'serial': serial, 'desc': desc}}}
                 )
-                logger.debug('Matched: {} -- Modified: {}'.format(update_results.matched_count, update_results.modified_count))
+                logger.debug('Matched: %s -- Modified: %s', update_results.matched_count, update_results.modified_count)
+                record_change(history, ip_addr, 'amc/{}/serial'.format(desc),
+                              None, serial)
             else:
                 amc_dict = find_results.get('amc')[0]
                 stored_serial = amc_dict.get('serial')
@@ -421,10 +794,79 @@ def get_7K_amc_info(fw, collection, ip_addr, lpc_slot):
                         {'ip-address': ip_addr, 'amc.desc': desc},
                         {'$set': {'amc.$.serial': serial}}
                     )
-                    logger.debug('Update AMC Serial Number -- Matched: {} -- Modified: {}'.format(update_results.matched_count, update_results.modified_count))
+                    logger.debug('Update AMC Serial Number -- Matched: %s -- Modified: %s', update_results.matched_count, update_results.modified_count)
+                    record_change(history, ip_addr,
+                                  'amc/{}/serial'.format(desc),
+                                  stored_serial, serial)
 
 
-def get_pano_info(collection):
+@collector('environmentals')
+def get_environmental_info(fw, collection, history, ip_addr, profile,
+                           chassis_occupancy):
+    """
+    Gets power supply and fan presence and alarm state from a single 'show
+    system environmentals' call and adds/updates database
+
+    Parameters
+    ----------
+    fw : Firewall
+        A PanDevice for the firewall
+    collection : Collection
+        A MongoDB database collection
+    history : Collection
+        The MongoDB change history collection
+    ip_addr : str
+        The IP address of the firewall
+    profile : dict
+        The hardware profile of the firewall model
+    chassis_occupancy : None
+        Unused, environmentals profiles do not track occupancy
+    """
+    logger.info('Starting')
+    results = fw.op('show system environmentals')
+
+    power_supplies = []
+    for entry in results.findall('./result/power-supply/*/entry'):
+        power_supplies.append({
+            'slot': entry.findtext('slot'),
+            'desc': entry.findtext('description'),
+            'present': entry.findtext('Inserted') == 'True',
+            'alarm': entry.findtext('alarm') == 'True'
+        })
+
+    fans = []
+    for entry in results.findall('./result/fan/*/entry'):
+        fans.append({
+            'slot': entry.findtext('slot'),
+            'desc': entry.findtext('description'),
+            'alarm': entry.findtext('alarm') == 'True'
+        })
+
+    find_results = collection.find_one(
+        {'ip-address': ip_addr},
+        {'power-supply': 1, 'fan': 1, '_id': 0}
+    ) or {}
+    logger.debug(find_results)
+
+    stored_supplies = dict((ps.get('desc'), ps) for ps in find_results.get('power-supply', []))
+    for powersupply_dict in power_supplies:
+        desc = powersupply_dict.get('desc')
+        stored_present = stored_supplies.get(desc, {}).get('present')
+        if stored_present != powersupply_dict.get('present'):
+            record_change(history, ip_addr,
+                          'power-supply/{}/present'.format(desc),
+                          stored_present, powersupply_dict.get('present'))
+
+    if (find_results.get('power-supply') != power_supplies
+            or find_results.get('fan') != fans):
+        update_results = collection.update_one(
+            {'ip-address': ip_addr},
+            {'$set': {'power-supply': power_supplies, 'fan': fans}}
+        )
+        logger.debug('Update Environmentals -- Matched: %s -- Modified: %s', update_results.matched_count, update_results.modified_count)
+
+
+def get_pano_info(collection, history):
     """
     Gets Palo Panorama info and adds/updates database
 
@@ -432,6 +874,8 @@ def get_pano_info(collection):
     ----------
     collection : Collection
         A MongoDB database collection
+    history : Collection
+        The MongoDB change history collection
     """
     logger.info('Starting')
 
@@ -469,6 +913,8 @@ def get_pano_info(collection):
                 }
             )
             logger.debug(insert_results)
+            record_change(history, ip_addr, 'serial', None, serial)
+            record_change(history, ip_addr, 'sw-version', None, sw_version)
         else:
             stored_serial = find_results.get('serial')
             if stored_serial != serial:
@@ -476,21 +922,217 @@ def get_pano_info(collection):
                     {"ip-address": ip_addr},
                     {'$set': {'serial': serial}}
                 )
-                logger.debug('Update Serial Number -- Matched: {} -- Modified: {}'.format(update_serial.matched_count, update_serial.modified_count))
+                logger.debug('Update Serial Number -- Matched: %s -- Modified: %s', update_serial.matched_count, update_serial.modified_count)
+                record_change(history, ip_addr, 'serial', stored_serial,
+                              serial)
+
+            stored_sw_version = find_results.get('sw-version')
+            if stored_sw_version != sw_version:
+                update_sw_version = collection.update_one(
+                    {"ip-address": ip_addr},
+                    {'$set': {'sw-version': sw_version}}
+                )
+                logger.debug('Update Software Version -- Matched: %s -- Modified: %s', update_sw_version.matched_count, update_sw_version.modified_count)
+                record_change(history, ip_addr, 'sw-version',
+                              stored_sw_version, sw_version)
+
+
+def write_snapshot(collection):
+    """
+    Writes the inventory to a gzip compressed JSON lines snapshot file for the
+    frontend to serve from when MongoDB is slow or down
+
+    The first line is a header with the snapshot version and generation time,
+    followed by one device document per line. The file is written to a
+    temporary name and renamed into place so readers never see a partial
+    snapshot
+
+    Parameters
+    ----------
+    collection : Collection
+        A MongoDB database collection
+    """
+    logger.info('Starting')
+    temp_file = snapshot_file + '.tmp'
+    count = 0
+
+    try:
+        with gzip.open(temp_file, 'wt') as snapshot:
+            snapshot.write(json.dumps({'version': SNAPSHOT_VERSION,
+                                       'generated': time.time()}) + '\n')
+            for device in collection.find({}, {'_id': 0}):
+                snapshot.write(json.dumps(device, default=str) + '\n')
+                count += 1
+        os.replace(temp_file, snapshot_file)
+    except (IOError, OSError) as error:
+        logger.error('Could not write snapshot: %s', error)
+    else:
+        logger.debug('Wrote %s devices to snapshot', count)
+
+
+def count_by(field):
+    """
+    Returns a facet counting devices by the value of a field
+
+    Parameters
+    ----------
+    field : str
+        The device field to group by
+
+    Returns
+    -------
+    facet : list
+        The aggregation stages of the facet
+    """
+    return [
+        {'$group': {'_id': '$' + field, 'count': {'$sum': 1}}},
+        {'$sort': {'_id': 1}}
+    ]
 
-        stored_sw_version = find_results.get('sw-version')
-        if stored_sw_version != sw_version:
-            update_sw_version = collection.update_one(
-                {"ip-address": ip_addr},
-                {'$set': {'sw-version': sw_version}}
-            )
-            logger.debug('Update Software Version -- Matched: {} -- Modified: {}'.format(update_sw_version.matched_count, update_sw_version.modified_count))
+
+def count_parts(field, condition=None):
+    """
+    Returns an expression counting the entries of a component array,
+    optionally only those matching a condition on '$$part'
+
+    Parameters
+    ----------
+    field : str
+        The component array field
+    condition : dict
+        An aggregation expression each counted entry must match
+
+    Returns
+    -------
+    expression : dict
+        The aggregation expression
+    """
+    parts = {'$ifNull': ['$' + field, []]}
+    if condition is not None:
+        parts = {'$filter': {'input': parts, 'as': 'part', 'cond': condition}}
+    return {'$size': parts}
+
+
+# Fleet aggregates for the frontend summary page, computed in a single pass
+# at the end of each sweep
+SUMMARY_PIPELINE = [
+    {'$facet': {
+        'models': count_by('model'),
+        'families': count_by('family'),
+        'sw-versions': count_by('sw-version'),
+        'power-supply-counts': [
+            {'$match': {'power-supply': {'$exists': True}}},
+            {'$group': {
+                '_id': {
+                    'model': '$model',
+                    'power-supplies': count_parts(
+                        'power-supply', {'$ne': ['$$part.present', False]})
+                },
+                'count': {'$sum': 1}
+            }},
+            {'$sort': {'_id.model': 1, '_id.power-supplies': 1}}
+        ],
+        'components': [
+            {'$group': {
+                '_id': None,
+                'chassis': {'$sum': count_parts('chassis')},
+                'power-supply': {'$sum': count_parts(
+                    'power-supply', {'$ne': ['$$part.present', False]})},
+                'power-supply-absent': {'$sum': count_parts(
+                    'power-supply', {'$eq': ['$$part.present', False]})},
+                'power-supply-alarm': {'$sum': count_parts(
+                    'power-supply', {'$eq': ['$$part.alarm', True]})},
+                'fantray': {'$sum': count_parts('fantray')},
+                'fan': {'$sum': count_parts('fan')},
+                'fan-alarm': {'$sum': count_parts(
+                    'fan', {'$eq': ['$$part.alarm', True]})},
+                'amc': {'$sum': count_parts('amc')}
+            }},
+            {'$project': {'_id': 0}}
+        ]
+    }}
+]
+
+
+def summarize_inventory(collection):
+    """
+    Runs SUMMARY_PIPELINE over the inventory
+
+    Counts are stored as value/count lists since values such as software
+    versions contain dots and cannot be used as MongoDB field names
+
+    Parameters
+    ----------
+    collection : Collection
+        A MongoDB database collection
+
+    Returns
+    -------
+    summary : dict
+        The fleet summary, in format of
+            dict: {
+                'models': [{'value': str, 'count': int}],
+                'families': [{'value': str, 'count': int}],
+                'sw-versions': [{'value': str, 'count': int}],
+                'power-supply-counts': [
+                    {'model': str, 'power-supplies': int, 'count': int}
+                    ],
+                'components': {'component': int}
+            }
+    """
+    logger.info('Starting')
+    start = time.time()
+
+    results = next(collection.aggregate(SUMMARY_PIPELINE))
+
+    summary = {
+        'models': [{'value': row['_id'], 'count': row['count']} for row in results['models']],
+        'families': [{'value': row['_id'], 'count': row['count']} for row in results['families']],
+        'sw-versions': [{'value': row['_id'], 'count': row['count']} for row in results['sw-versions']],
+        'power-supply-counts': [
+            {'model': row['_id'].get('model'),
+             'power-supplies': row['_id'].get('power-supplies'),
+             'count': row['count']}
+            for row in results['power-supply-counts']
+        ],
+        'components': results['components'][0] if results['components'] else {}
+    }
+
+    logger.debug('Summary aggregation took %.1f ms', (time.time() - start) * 1000)
+    return summary
+
+
+def record_sweep(meta, summary):
+    """
+    Stores the fleet summary and increments the sweep generation so the
+    frontend knows to refresh its cached copy
+
+    Parameters
+    ----------
+    meta : Collection
+        The MongoDB inventory metadata collection
+    summary : dict
+        The fleet summary from summarize_inventory
+    """
+    update_results = meta.update_one(
+        {'_id': 'sweep'},
+        {
+            '$inc': {'generation': 1},
+            '$set': {
+                'finished': datetime.datetime.utcnow(),
+                'summary': summary
+            }
+        },
+        upsert=True
+    )
+    logger.debug('Update Sweep Generation -- Matched: %s -- Modified: %s', update_results.matched_count, update_results.modified_count)
 
 
 def main():
     """
     Connects to MongoDB and uses 'inventory' database and 'paloalto' collection
-    to capture all connected Palos inventory data
+    to capture all connected Palos inventory data, recording changes in the
+    'paloalto_history' collection
     """
     logger.info('Starting')
 
@@ -509,16 +1151,24 @@ def main():
 
         logger.debug('Connected to MongoDB successfully')
     except pymongo.errors.ConnectionFailure as error:
-        logger.error('Could not connect to MongoDB: {}'.format(error))
+        logger.error('Could not connect to MongoDB: %s', error)
     else:
         db = client['inventory']
         collection = db['paloalto']
+        history = db['paloalto_history']
+        create_history_indexes(history)
 
         pano = pa.get_active_pano()
-        device_dict = get_connected_devices(pano, collection)
-        get_7K_info(device_dict, collection)
-        get_pano_info(collection)
+        device_dict = get_connected_devices(pano, collection, history)
+        get_hardware_info(device_dict, collection, history, pano)
+        get_pano_info(collection, history)
+        write_snapshot(collection)
+        record_sweep(db['paloalto_meta'], summarize_inventory(collection))
 
 
 if __name__ == '__main__':
-    main()
+    log_listener.start()
+    try:
+        main()
+    finally:
+        log_listener.stop()
@@ -21,8 +21,57 @@
 # SOFTWARE.
 
 import re
+import ssl
+import http.client
+import xml.etree.ElementTree as ET
+from urllib.parse import urlencode
+from urllib.request import urlopen
 import config
 from pandevice import panorama
+from pandevice.errors import PanDeviceXapiError
+
+DEVICE_FIELDS = ('serial', 'hostname', 'ip-address', 'family', 'model',
+                 'sw-version', 'uptime')
+DEVICES_CONNECTED_CMD = '<show><devices><connected></connected></devices></show>'
+
+# Hardware profiles keyed by model. 'collectors' is the command plan run
+# against the firewall, in order, by the collectors registered in
+# pan_inventory. 'occupancy' marks profiles whose collectors use the
+# persisted chassis occupancy map. Models without a profile are not probed
+# for hardware.
+PA_7080_PROFILE = {
+    'collectors': ('chassis', 'power', 'fan', 'amc'),
+    'occupancy': True,
+    'smc_slot': '6',
+    'lpc_slot': '7',
+    'ps_total': 8,
+    'slot_total': 12
+}
+
+PA_7050_PROFILE = {
+    'collectors': ('chassis', 'power', 'fan', 'amc'),
+    'occupancy': True,
+    'smc_slot': '4',
+    'lpc_slot': '8',
+    'ps_total': 4,
+    'slot_total': 8
+}
+
+ENVIRONMENTALS_PROFILE = {
+    'collectors': ('environmentals',)
+}
+
+MODEL_PROFILES = {
+    'PA-7080': PA_7080_PROFILE,
+    'PA-7050': PA_7050_PROFILE,
+    'PA-5280': ENVIRONMENTALS_PROFILE,
+    'PA-5260': ENVIRONMENTALS_PROFILE,
+    'PA-5250': ENVIRONMENTALS_PROFILE,
+    'PA-5220': ENVIRONMENTALS_PROFILE,
+    'PA-3260': ENVIRONMENTALS_PROFILE,
+    'PA-3250': ENVIRONMENTALS_PROFILE,
+    'PA-3220': ENVIRONMENTALS_PROFILE
+}
 
 
 def get_active_pano():
@@ -85,6 +134,118 @@ def get_ha_status(pano):
     return ha_status
 
 
+def parse_uptime(uptime):
+    """
+    Converts a PAN-OS uptime string such as '12 days, 3:04:05' to seconds
+
+    Parameters
+    ----------
+    uptime : str
+        The uptime as reported by the device
+
+    Returns
+    -------
+    seconds : int
+        The uptime in seconds, or None if it could not be parsed
+    """
+    if not uptime:
+        return None
+
+    match = re.search(r'(?:(\d+)\s+days?,\s*)?(\d+):(\d+):(\d+)', uptime)
+    if match is None:
+        return None
+
+    days, hours, minutes, seconds = [int(num or 0) for num in match.groups()]
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def parse_device_entry(entry):
+    """
+    Pulls the inventory fields out of a single connected device entry
+
+    Parameters
+    ----------
+    entry : Element
+        A 'show devices connected' device entry
+
+    Returns
+    -------
+    device : dict
+        A dictionary of the device's serial, hostname, ip-address, family,
+        model, sw-version, and uptime
+    """
+    return dict((field, entry.findtext(field)) for field in DEVICE_FIELDS)
+
+
+def iter_connected_devices(pano, stream=None):
+    """
+    Yields the connected devices from Panorama one at a time
+
+    When streaming, the raw XML response is read straight off the socket and
+    parsed incrementally with iterparse, clearing each device entry once it
+    has been processed so memory stays flat regardless of fleet size
+
+    Parameters
+    ----------
+    pano : Panorama
+        A PanDevice for Panorama
+    stream : bool
+        Parse the raw response incrementally, defaults to the
+        'stream_connected_devices' config value
+
+    Yields
+    ------
+    device : dict
+        A dictionary of the device's serial, hostname, ip-address, family,
+        model, sw-version, and uptime
+
+    Raises
+    ------
+    PanDeviceXapiError
+        If Panorama does not return a successful response
+    """
+    if stream is None:
+        stream = config.paloalto.get('stream_connected_devices', False)
+
+    if not stream:
+        results = pano.op('show devices connected')
+        for entry in results.findall('./result/devices/entry'):
+            yield parse_device_entry(entry)
+        return
+
+    # The key goes in the POST body, as pan.xapi sends it, so it stays out of
+    # access and proxy logs
+    url = 'https://{}:{}/api/'.format(pano.hostname, pano.port)
+    query = urlencode({'type': 'op',
+                       'cmd': DEVICES_CONNECTED_CMD,
+                       'key': pano.api_key})
+
+    response = urlopen(url, data=query.encode('utf-8'), timeout=pano.timeout)
+    try:
+        path = []
+        devices = None
+        status = None
+        for event, elem in ET.iterparse(response, events=('start', 'end')):
+            if event == 'start':
+                path.append(elem.tag)
+                if path == ['response']:
+                    status = elem.get('status')
+                elif path == ['response', 'result', 'devices']:
+                    devices = elem
+                continue
+
+            if path == ['response'] and status != 'success':
+                message = ' '.join(text.strip() for text in elem.itertext() if text.strip())
+                raise PanDeviceXapiError('show devices connected failed with status {}: {}'.format(status, message))
+
+            if path == ['response', 'result', 'devices', 'entry']:
+                yield parse_device_entry(elem)
+                devices.clear()
+            path.pop()
+    finally:
+        response.close()
+
+
 def get_connected_devices(pano):
     """
     Get the connected devices info from Panorama and adds/updates database
@@ -105,29 +266,156 @@ def get_connected_devices(pano):
                     'ip_address': str,
                     'family': str,
                     'model': str,
-                    'software_version': str
+                    'software_version': str,
+                    'uptime': str
                     }
             }
     """
-    results = pano.op('show devices connected')
-
     device_dict = {}
 
-    devices_xml_list = results.findall('./result/devices/entry')
+    for device in iter_connected_devices(pano):
+        device_dict[device.get('serial')] = device
 
-    for device in devices_xml_list:
-        serial = device.find('./serial').text
-        hostname = device.find('./hostname').text
-        ip_addr = device.find('./ip-address').text
-        family = device.find('./family').text
-        model = device.find('./model').text
-        sw_version = device.find('./sw-version').text
+    return device_dict
 
-        device_dict[serial] = {'hostname': hostname,
-                               'ip-address': ip_addr,
-                               'serial': serial,
-                               'family': family,
-                               'model': model,
-                               'sw-version': sw_version}
 
-    return device_dict
+def cmd_to_xml(cmd):
+    """
+    Converts a simple op command such as 'show system environmentals' to its
+    XML form
+
+    Parameters
+    ----------
+    cmd : str
+        The op command
+
+    Returns
+    -------
+    cmd_xml : str
+        The op command as nested XML elements
+    """
+    words = cmd.split()
+    return (''.join('<{}>'.format(word) for word in words)
+            + ''.join('</{}>'.format(word) for word in reversed(words)))
+
+
+class PanoramaConnection(object):
+    """
+    A single persistent HTTPS connection to Panorama used to send op commands
+    to its managed firewalls by serial number
+
+    Requests are sent one at a time over the kept-alive connection, so the
+    TCP and TLS session and the API key are reused for every firewall instead
+    of opening a session per request
+
+    Parameters
+    ----------
+    pano : Panorama
+        A PanDevice for the active Panorama
+    """
+    def __init__(self, pano):
+        self.api_key = pano.api_key
+        self.connection = http.client.HTTPSConnection(
+            pano.hostname,
+            pano.port,
+            timeout=pano.timeout,
+            context=ssl.create_default_context()
+        )
+
+    def request(self, body):
+        """
+        Posts the request body to the XML API, reconnecting once if Panorama
+        has closed the kept-alive connection
+
+        Parameters
+        ----------
+        body : str
+            The URL encoded request body
+
+        Returns
+        -------
+        response : bytes
+            The raw XML API response
+        """
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+        for attempt in range(2):
+            try:
+                self.connection.request('POST', '/api/', body, headers)
+                return self.connection.getresponse().read()
+            except (http.client.HTTPException, ConnectionError):
+                self.connection.close()
+                if attempt:
+                    raise
+
+    def op(self, serial, cmd, cmd_xml=True, xml=False):
+        """
+        Runs an op command on a firewall through Panorama
+
+        Parameters
+        ----------
+        serial : str
+            The serial number of the firewall
+        cmd : str
+            The op command
+        cmd_xml : bool
+            Convert a plain text command to XML
+        xml : bool
+            Return the response as an XML string instead of an Element
+
+        Returns
+        -------
+        results : Element or str
+            The XML API response
+
+        Raises
+        ------
+        PanDeviceXapiError
+            If Panorama does not return a successful response
+        """
+        if cmd_xml:
+            cmd = cmd_to_xml(cmd)
+
+        body = urlencode({'type': 'op',
+                          'cmd': cmd,
+                          'target': serial,
+                          'key': self.api_key})
+        results = ET.fromstring(self.request(body))
+
+        if results.get('status') != 'success':
+            message = ' '.join(text.strip() for text in results.itertext() if text.strip())
+            raise PanDeviceXapiError('{} on {} failed with status {}: {}'.format(cmd, serial, results.get('status'), message))
+
+        if xml:
+            return ET.tostring(results, encoding='unicode')
+        return results
+
+    def close(self):
+        """
+        Closes the connection to Panorama
+        """
+        self.connection.close()
+
+
+class ProxiedFirewall(object):
+    """
+    Stands in for a firewall PanDevice, sending its op commands through a
+    shared PanoramaConnection
+
+    Parameters
+    ----------
+    connection : PanoramaConnection
+        The persistent connection to Panorama
+    serial : str
+        The serial number of the firewall
+    """
+    def __init__(self, connection, serial):
+        self.connection = connection
+        self.serial = serial
+
+    def op(self, cmd=None, cmd_xml=True, xml=False):
+        """
+        Runs an op command on the firewall through Panorama, matching the
+        Firewall.op arguments used by the collectors
+        """
+        return self.connection.op(self.serial, cmd, cmd_xml=cmd_xml, xml=xml)
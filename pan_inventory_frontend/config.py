@@ -35,5 +35,16 @@ mongo = {
     'backup_username': '<BACKUP_USERNAME>',
     'backup_password': '<BACKUP_PASSWORD>',
     'mongodb_ip': '<MONGO_IP>',
-    'mongodb_port': 27017
+    'mongodb_port': 27017,
+    'batch_size': 1000
+    }
+
+snapshot = {
+    'file': '/usr/local/bin/snapshot/pa_inventory.jsonl.gz',
+    'mode': False,
+    'latency_budget_ms': 500
+    }
+
+logs = {
+    'level': 'INFO'
     }
@@ -21,15 +21,228 @@
 # SOFTWARE.
 
 import re
+import os
+import gzip
+import json
+import mmap
+import time
 import prettytable
+import pymongo
 from pymongo import MongoClient
-from flask import Flask, render_template
+from flask import Flask, render_template, request, jsonify
 from flask_bootstrap import Bootstrap
 import config
 
 app = Flask(__name__)
+app.logger.setLevel(config.logs['level'])
 bootstrap = Bootstrap(app)
 
+HISTORY_LIMIT = 500
+SNAPSHOT_VERSION = 1
+
+DEVICE_PROJECTION = {
+    '_id': 0,
+    'hostname': 1,
+    'ip-address': 1,
+    'serial': 1,
+    'model': 1,
+    'sw-version': 1
+}
+
+PARTS_FIELDS = ['chassis', 'power-supply', 'fantray', 'amc']
+
+# Only devices the backend has collected hardware for have component arrays,
+# so the hardware profiles stay the single source of model coverage
+PARTS_MATCH = {'$or': [{field: {'$exists': True}} for field in PARTS_FIELDS]}
+
+
+def part_rows(field, desc, model, slot):
+    '''
+    Returns an aggregation expression mapping a component array to parts
+    table rows of desc, serial, model, and slot
+    '''
+    return {'$map': {
+        'input': {'$ifNull': ['$' + field, []]},
+        'as': 'part',
+        'in': {
+            'desc': desc,
+            'serial': {'$ifNull': ['$$part.serial', 'N/A']},
+            'model': model,
+            'slot': slot
+        }
+    }}
+
+
+# Flattens the component arrays of each device into one document per part
+# so only the parts table columns are sent back from MongoDB
+PARTS_PIPELINE = [
+    {'$match': PARTS_MATCH},
+    {'$project': {
+        '_id': 0,
+        'hostname': 1,
+        'part': {'$concatArrays': [
+            part_rows('chassis', '$$part.type', '$$part.model', '$$part.slot'),
+            part_rows('power-supply', '$$part.desc',
+                      {'$ifNull': ['$$part.model', 'N/A']},
+                      {'$literal': 'N/A'}),
+            part_rows('fantray', '$$part.desc', '$$part.model',
+                      {'$literal': 'N/A'}),
+            part_rows('amc', '$$part.desc', {'$literal': 'N/A'},
+                      {'$literal': 'N/A'})
+        ]}
+    }},
+    {'$unwind': '$part'},
+    {'$project': {
+        'hostname': 1,
+        'desc': '$part.desc',
+        'serial': '$part.serial',
+        'model': '$part.model',
+        'slot': '$part.slot'
+    }}
+]
+
+
+mongo_client = None
+snapshot_cache = (None, [], [])
+# Cache key before any generation has been read, so a missing sweep document
+# (generation None) is cached like any other generation
+NO_GENERATION = object()
+summary_cache = (NO_GENERATION, None)
+
+
+def get_database():
+    '''
+    Returns the 'inventory' database, reusing one MongoClient (and its
+    connection pool) across requests
+    '''
+    global mongo_client
+
+    if mongo_client is None:
+        mongo_client = MongoClient(
+            host=config.mongo['mongodb_ip'],
+            port=config.mongo['mongodb_port'],
+            username=config.mongo['read_username'],
+            password=config.mongo['read_password'],
+            serverSelectionTimeoutMS=config.snapshot['latency_budget_ms'],
+            connectTimeoutMS=config.snapshot['latency_budget_ms']
+        )
+
+    return mongo_client['inventory']
+
+
+def flatten_parts(devices):
+    '''
+    Returns the parts table rows of full device documents, matching the
+    output of PARTS_PIPELINE
+    '''
+    parts = []
+
+    for device_dict in devices:
+        hostname = device_dict.get('hostname')
+
+        for chassis_dict in device_dict.get('chassis', []):
+            parts.append({'hostname': hostname,
+                          'desc': chassis_dict.get('type'),
+                          'serial': chassis_dict.get('serial', 'N/A'),
+                          'model': chassis_dict.get('model'),
+                          'slot': chassis_dict.get('slot')})
+
+        for powersupply_dict in device_dict.get('power-supply', []):
+            parts.append({'hostname': hostname,
+                          'desc': powersupply_dict.get('desc'),
+                          'serial': powersupply_dict.get('serial', 'N/A'),
+                          'model': powersupply_dict.get('model', 'N/A'),
+                          'slot': 'N/A'})
+
+        for fantray_dict in device_dict.get('fantray', []):
+            parts.append({'hostname': hostname,
+                          'desc': fantray_dict.get('desc'),
+                          'serial': fantray_dict.get('serial', 'N/A'),
+                          'model': fantray_dict.get('model'),
+                          'slot': 'N/A'})
+
+        for amc_dict in device_dict.get('amc', []):
+            parts.append({'hostname': hostname,
+                          'desc': amc_dict.get('desc'),
+                          'serial': amc_dict.get('serial', 'N/A'),
+                          'model': 'N/A',
+                          'slot': 'N/A'})
+
+    return parts
+
+
+def load_snapshot():
+    '''
+    Returns the devices and parts rows from the backend's snapshot file,
+    memory-mapping and parsing it only when the file has changed since the
+    last load
+    '''
+    global snapshot_cache
+
+    snapshot_file = config.snapshot['file']
+    stat = os.stat(snapshot_file)
+    snapshot_key = (stat.st_ino, stat.st_size, stat.st_mtime)
+
+    if snapshot_cache[0] != snapshot_key:
+        with open(snapshot_file, 'rb') as snapshot:
+            mapped = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                lines = gzip.GzipFile(fileobj=mapped).read().splitlines()
+            finally:
+                mapped.close()
+
+        header = json.loads(lines[0].decode('utf-8'))
+        if header.get('version') != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot version: {}'.format(header.get('version')))
+
+        devices = [json.loads(line.decode('utf-8')) for line in lines[1:]]
+        snapshot_cache = (snapshot_key, devices, flatten_parts(devices))
+
+    return snapshot_cache[1], snapshot_cache[2]
+
+
+def query_inventory(collection):
+    '''
+    Returns the devices and parts rows from MongoDB, projecting the devices
+    table columns and flattening the parts table with PARTS_PIPELINE
+
+    The latency budget covers both reads, the parts aggregation only gets
+    what the devices query left of it
+    '''
+    budget = config.snapshot['latency_budget_ms']
+    batch_size = config.mongo['batch_size']
+    deadline = time.time() + budget / 1000.0
+
+    start = time.time()
+    devices = list(collection.find({}, DEVICE_PROJECTION)
+                   .batch_size(batch_size).max_time_ms(budget))
+    app.logger.info('Devices query returned %s rows in %.1f ms', len(devices), (time.time() - start) * 1000)
+
+    remaining = int((deadline - time.time()) * 1000)
+    if remaining <= 0:
+        raise pymongo.errors.ExecutionTimeout('Devices query used the whole latency budget')
+
+    start = time.time()
+    parts = list(collection.aggregate(PARTS_PIPELINE, batchSize=batch_size,
+                                      maxTimeMS=remaining))
+    app.logger.info('Parts aggregation returned %s rows in %.1f ms', len(parts), (time.time() - start) * 1000)
+
+    return devices, parts
+
+
+def get_inventory():
+    '''
+    Returns the devices and parts rows from MongoDB, or from the snapshot file
+    when in snapshot mode or when MongoDB misses the latency budget
+    '''
+    if not config.snapshot['mode']:
+        try:
+            return query_inventory(get_database()['paloalto'])
+        except pymongo.errors.PyMongoError as error:
+            app.logger.warning('MongoDB unavailable, serving snapshot: %s', error)
+
+    return load_snapshot()
+
 
 def update_html(html):
     '''
@@ -56,71 +269,30 @@ def update_html(html):
 @app.route("/")
 def palo_inventory():
     '''
-    Connects to MongoDB and uses 'inventory' database and 'paloalto' collection
-    to gather Palos inventory data for display using Flask
+    Uses the 'inventory' database and 'paloalto' collection, or the snapshot
+    file, to gather Palos inventory data for display using Flask
     '''
     try:
-        username = config.mongo['read_username']
-        password = config.mongo['read_password']
-        mongodb_ip = config.mongo['mongodb_ip']
-        mongodb_port = config.mongo['mongodb_port']
-
-        client = MongoClient(
-            host=mongodb_ip,
-            port=mongodb_port,
-            username=username,
-            password=password
-        )
-    except pymongo.errors.ConnectionFailure as error:
-        print('Could not connect to MongoDB: {}'.format(error))
+        devices, parts = get_inventory()
+    except (IOError, OSError, ValueError) as error:
+        app.logger.error('Could not load inventory snapshot: %s', error)
+        return 'Inventory unavailable', 503
     else:
-        db = client['inventory']
-        collection = db['paloalto']
-
-        find_results = collection.find()
-
         main_table = prettytable.PrettyTable(['Hostname', 'IP Address', 'Serial Number', 'Model', 'Software Version'])
 
         parts_table = prettytable.PrettyTable(['Hostname', 'Description', 'Serial Number', 'Model', 'Slot'])
 
-        for device_dict in find_results:
+        for device_dict in devices:
             hostname = device_dict.get('hostname')
             ip_address = device_dict.get('ip-address')
             serial = device_dict.get('serial')
             model = device_dict.get('model')
             sw_version = device_dict.get('sw-version')
-            family = device_dict.get('family')
 
             main_table.add_row([hostname, ip_address, serial, model, sw_version])
 
-            if family == '7000':
-                chassis_list = device_dict.get('chassis')
-                for chassis_dict in chassis_list:
-                    chassis_slot = chassis_dict.get('slot')
-                    chassis_model = chassis_dict.get('model')
-                    chassis_type = chassis_dict.get('type')
-                    chassis_serial = chassis_dict.get('serial')
-                    parts_table.add_row([hostname, chassis_type, chassis_serial, chassis_model, chassis_slot])
-
-                powersupply_list = device_dict.get('power-supply')
-                for powersupply_dict in powersupply_list:
-                    powersupply_model = powersupply_dict.get('model')
-                    powersupply_serial = powersupply_dict.get('serial')
-                    powersupply_desc = powersupply_dict.get('desc')
-                    parts_table.add_row([hostname, powersupply_desc, powersupply_serial, powersupply_model, "N/A"])
-
-                fantray_list = device_dict.get('fantray')
-                for fantray_dict in fantray_list:
-                    fantray_model = fantray_dict.get('model')
-                    fantray_serial = fantray_dict.get('serial')
-                    fantray_desc = fantray_dict.get('desc')
-                    parts_table.add_row([hostname, fantray_desc, fantray_serial, fantray_model, "N/A"])
-
-                amc_list = device_dict.get('amc')
-                for amc_dict in amc_list:
-                    amc_serial = amc_dict.get('serial')
-                    amc_desc = amc_dict.get('desc')
-                    parts_table.add_row([hostname, amc_desc, amc_serial, "N/A", "N/A"])
+        for part_dict in parts:
+            parts_table.add_row([part_dict.get('hostname'), part_dict.get('desc'), part_dict.get('serial'), part_dict.get('model'), part_dict.get('slot')])
 
         main_table_html = main_table.get_html_string(attributes={"id": "main_table", "class": "display"})
         parts_table_html = parts_table.get_html_string(attributes={"id": "parts_table", "class": "display"})
@@ -131,5 +303,149 @@ def palo_inventory():
         return render_template('inventory.html', main_table=main_table_html_updated, parts_table=parts_table_html_updated)
 
 
+def count_dict(rows):
+    '''
+    Returns stored value/count rows as a dict, labelling a missing value
+    'unknown' so the keys stay sortable for jsonify
+    '''
+    counts = {}
+
+    for row in rows:
+        value = row['value'] if row['value'] is not None else 'unknown'
+        counts[value] = counts.get(value, 0) + row['count']
+
+    return counts
+
+
+def get_summary():
+    '''
+    Returns the fleet summary stored by the backend at the end of each sweep,
+    only reading it again when the sweep generation changes
+    '''
+    global summary_cache
+
+    meta = get_database()['paloalto_meta']
+    sweep = meta.find_one({'_id': 'sweep'}, {'generation': 1})
+    generation = sweep.get('generation') if sweep else None
+
+    if summary_cache[0] == generation:
+        return summary_cache[1]
+
+    sweep = meta.find_one({'_id': 'sweep'}, {'generation': 1, 'summary': 1})
+    generation = sweep.get('generation') if sweep else None
+    stored = sweep.get('summary') if sweep else None
+
+    if stored is None:
+        summary = None
+    else:
+        models = count_dict(stored['models'])
+        summary = {
+            'generation': generation,
+            'devices': sum(models.values()),
+            'models': models,
+            'families': count_dict(stored['families']),
+            'sw-versions': count_dict(stored['sw-versions']),
+            'power-supply-counts': stored['power-supply-counts'],
+            'components': stored['components']
+        }
+    summary_cache = (generation, summary)
+
+    return summary
+
+
+def get_cached_summary():
+    '''
+    Returns the fleet summary, falling back to the last cached summary when
+    MongoDB is unavailable
+    '''
+    try:
+        return get_summary()
+    except pymongo.errors.PyMongoError as error:
+        app.logger.warning('MongoDB unavailable, serving cached summary: %s', error)
+        return summary_cache[1]
+
+
+@app.route("/summary")
+def summary():
+    '''
+    Displays per-model, per-family and per-sw-version device counts and
+    component totals
+    '''
+    fleet_summary = get_cached_summary()
+    if fleet_summary is None:
+        return 'Summary unavailable', 503
+
+    tables = []
+
+    for title, field in (('Model', 'models'), ('Family', 'families'), ('Software Version', 'sw-versions')):
+        table = prettytable.PrettyTable([title, 'Devices'])
+        for value, count in sorted(fleet_summary[field].items()):
+            table.add_row([value, count])
+        tables.append(table)
+
+    power_table = prettytable.PrettyTable(['Model', 'Power Supplies', 'Devices'])
+    for row in fleet_summary['power-supply-counts']:
+        power_table.add_row([row['model'], row['power-supplies'], row['count']])
+    tables.append(power_table)
+
+    component_table = prettytable.PrettyTable(['Component', 'Count'])
+    for component, count in sorted(fleet_summary['components'].items()):
+        component_table.add_row([component, count])
+    tables.append(component_table)
+
+    tables_html = [update_html(table.get_html_string(attributes={"id": "summary_table_{}".format(num), "class": "display"})) for num, table in enumerate(tables)]
+
+    return render_template('summary.html', devices=fleet_summary['devices'], tables=tables_html)
+
+
+@app.route("/api/summary")
+def summary_api():
+    '''
+    Serves the fleet summary as JSON
+    '''
+    fleet_summary = get_cached_summary()
+    if fleet_summary is None:
+        return jsonify({'error': 'Summary unavailable'}), 503
+
+    return jsonify(fleet_summary)
+
+
+def get_history(query):
+    '''
+    Returns the newest first change events matching the query from the
+    'paloalto_history' collection as JSON, limited by the 'limit' argument
+    '''
+    # A limit of 0 means no limit to MongoDB, so clamp to 1..HISTORY_LIMIT
+    limit = request.args.get('limit', HISTORY_LIMIT, type=int)
+    limit = max(1, min(limit, HISTORY_LIMIT))
+
+    try:
+        history = get_database()['paloalto_history']
+        events = list(history.find(query, {'_id': 0}).sort(
+            'timestamp', pymongo.DESCENDING).limit(limit))
+    except pymongo.errors.PyMongoError as error:
+        app.logger.error('Could not query change history: %s', error)
+        return jsonify({'error': 'History unavailable'}), 503
+
+    return jsonify(events)
+
+
+@app.route("/history/device/<ip_address>")
+def device_history(ip_address):
+    '''
+    Serves the change timeline of a device by IP address
+    '''
+    return get_history({'ip-address': ip_address})
+
+
+@app.route("/history/serial/<serial>")
+def serial_history(serial):
+    '''
+    Serves the change timeline of a serial number, covering when it was
+    installed and when it was replaced
+    '''
+    return get_history({'$or': [{'old': serial}, {'new': serial}]})
+
+
 if __name__ == '__main__':
     app.run()